@@ -9,6 +9,7 @@
 
 """
 
+import shlex
 import pipeline
 
 
@@ -20,23 +21,37 @@ def snpeff(job, config, name, input_vcf):
     :type sample: str.
     :param input_vcf: The input_vcf file name to process.
     :type input_vcf: str.
-    :returns:  str -- The output vcf file name.
+    :returns:  str -- The output bgzipped and tabix indexed vcf file name.
     """
 
-    output_vcf = "{}.snpEff.{}.vcf".format(name, config['snpeff']['reference'])
+    output_vcf = "{}.snpEff.{}.vcf.gz".format(name, config['snpeff']['reference'])
     logfile = "{}.snpeff.log".format(name)
+    tabix_logfile = "{}.snpeff.tabix.log".format(name)
+
+    snpeff_command = pipeline.java_command(config['snpeff']['bin'],
+                                           pipeline.java_opts(pipeline.java_xmx(config['snpeff']['max_mem'])))
+    snpeff_command.extend(["-onlyTr",
+                           "{}".format(config['transcripts']),
+                           "-v",
+                           "{}".format(config['snpeff']['reference']),
+                           "{}".format(input_vcf)])
+
+    bgzip_command = ["bgzip",
+                     "-@",
+                     "{}".format(config['snpeff'].get('num_cores', 1)),
+                     "-c"]
+
+    tabix_command = ["tabix",
+                     "-p",
+                     "vcf",
+                     "{}".format(output_vcf)]
 
-    snpeff_command = ["{}".format(config['snpeff']['bin']),
-                      "-Xmx{}g".format(config['snpeff']['max_mem']),
-                      "-onlyTr {}".format(config['transcripts']),
-                      "-v",
-                      "{}".format(config['snpeff']['reference']),
-                      "{}".format(input_vcf),
-                      ">"
-                      "{}".format(output_vcf)]
+    job.fileStore.logToMaster("snpEff Command: {} | {}\n".format(snpeff_command, bgzip_command))
+    pipeline.run_and_log_pipeline([snpeff_command, bgzip_command], logfile, env=pipeline.java_env(),
+                                  stdout_path=output_vcf)
 
-    job.fileStore.logToMaster("snpEff Command: {}\n".format(snpeff_command))
-    pipeline.run_and_log_command(" ".join(snpeff_command), logfile)
+    job.fileStore.logToMaster("Tabix Command: {}\n".format(tabix_command))
+    pipeline.run_and_log_command(tabix_command, tabix_logfile)
 
     return output_vcf
 
@@ -55,19 +70,19 @@ def gemini(job, config, name, input_vcf):
     db = "{}.snpEff.{}.db".format(name, config['snpeff']['reference'])
     logfile = "{}.gemini.log".format(name)
 
-    command = ["{}".format(config['gemini']['bin']),
-               "load",
-               "--cores",
-               "{}".format(config['gemini']['num_cores']),
-               "--save-info-string",
-               "-v",
-               "{}".format(input_vcf),
-               "-t",
-               "snpEff",
-               "{}".format(db)]
+    command = shlex.split(config['gemini']['bin'])
+    command.extend(["load",
+                    "--cores",
+                    "{}".format(config['gemini']['num_cores']),
+                    "--save-info-string",
+                    "-v",
+                    "{}".format(input_vcf),
+                    "-t",
+                    "snpEff",
+                    "{}".format(db)])
 
     job.fileStore.logToMaster("GEMINI Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_and_log_command(command, logfile)
 
     return db
 
@@ -86,17 +101,15 @@ def vcfanno(job, config, name, samples, input_vcf):
     output_vcf = "{}.vcfanno.snpEff.{}.vcf".format(name, config['snpeff']['reference'])
     logfile = "{}.vcfanno.log".format(name)
 
-    command = ["{}".format(config['vcfanno']['bin']),
-               "-p",
-               "{}".format(config['vcfanno']['num_cores']),
-               "--lua",
-               "{}".format(config['vcfanno']['lua']),
-               "{}".format(samples[name]['vcfanno_config']),
-               "{}".format(input_vcf),
-               ">",
-               "{}".format(output_vcf)]
+    command = shlex.split(config['vcfanno']['bin'])
+    command.extend(["-p",
+                    "{}".format(config['vcfanno']['num_cores']),
+                    "--lua",
+                    "{}".format(config['vcfanno']['lua']),
+                    "{}".format(samples[name]['vcfanno_config']),
+                    "{}".format(input_vcf)])
 
     job.fileStore.logToMaster("VCFAnno Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_and_log_command(command, logfile, stdout_path=output_vcf)
 
     return output_vcf
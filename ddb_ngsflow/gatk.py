@@ -7,8 +7,195 @@
 
 """
 
+import os
+import errno
 import pipeline
 
+from collections import namedtuple
+
+# Errors from os.link where a symlink can be used instead
+HARDLINK_UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK)
+
+# Maximum heap size in GB for each tool, the configured max_mem still applies when lower
+TOOL_MAX_MEM = {'DiagnoseTargets': 2,
+                'VariantFiltration': 4,
+                'VariantAnnotator': 8,
+                'MarkDuplicates': 8,
+                'AddOrReplaceReadGroups': 4,
+                'RealignerTargetCreator': 8,
+                'IndelRealigner': 8,
+                'BaseRecalibrator': 16,
+                'PrintReads': 8,
+                'MergeSamFiles': 4}
+
+# Argument templates for each tool, filled in per job by GATKContext.command
+DIAGNOSE_TARGETS = ("-T", "DiagnoseTargets",
+                    "-R", "{reference}",
+                    "-L", "{regions}",
+                    "--coverage_status_threshold", "{coverage_loci_threshold}",
+                    "--bad_mate_status_threshold", "{bad_mate_threshold}",
+                    "--minimum_coverage", "{coverage_threshold}",
+                    "--quality_status_threshold", "{quality_loci_threshold}",
+                    "-I", "{input_bam}",
+                    "-o", "{output_vcf}",
+                    "--missing_intervals", "{missing_intervals}")
+
+DIAGNOSE_POOLED_TARGETS = ("-T", "DiagnoseTargets",
+                           "-R", "{reference}",
+                           "-L", "{regions}",
+                           "--coverage_status_threshold", "{coverage_loci_threshold}",
+                           "--bad_mate_status_threshold", "{bad_mate_threshold}",
+                           "--minimum_coverage", "{coverage_threshold}",
+                           "--quality_status_threshold", "{quality_loci_threshold}",
+                           "-I", "{input_bam1}",
+                           "-I", "{input_bam2}",
+                           "-o", "{output_vcf}",
+                           "--missing_intervals", "{missing_intervals}")
+
+VARIANT_ANNOTATOR = ("-T", "VariantAnnotator",
+                     "-R", "{reference}",
+                     "-nt", "{num_cores}",
+                     "--group", "StandardAnnotation",
+                     "--dbsnp", "{dbsnp}",
+                     "-I", "{input_bam}",
+                     "--variant", "{input_vcf}",
+                     "-L", "{input_vcf}",
+                     "-o", "{output_vcf}")
+
+VARIANT_FILTRATION = ("-T", "VariantFiltration",
+                      "-R", "{reference}",
+                      "--filterExpression", "MQ0 > {mq0_threshold}",
+                      "--filterName", "HighMQ0",
+                      "--filterExpression", "DP < {coverage_threshold}",
+                      "--filterName", "LowDepth",
+                      "--filterExpression", "QUAL < {var_qual_threshold}",
+                      "--filterName", "LowQual",
+                      "--filterExpression", "MQ < {map_qual_threshold}",
+                      "--filterName", "LowMappingQual",
+                      "--variant", "{input_vcf}",
+                      "-o", "{output_vcf}")
+
+MARK_DUPLICATES = ("MarkDuplicates",
+                   "CREATE_INDEX=true",
+                   "METRICS_FILE={metrics_file}",
+                   "INPUT={input_bam}",
+                   "OUTPUT={output_bam}")
+
+ADD_OR_REPLACE_READGROUPS = ("AddOrReplaceReadGroups",
+                             "INPUT={input_bam}",
+                             "OUTPUT={output_bam}",
+                             "RGID={name}",
+                             "RGSM={name}",
+                             "RGLB={name}",
+                             "RGPL=illumina",
+                             "RGPU=miseq",
+                             "SORT_ORDER=coordinate",
+                             "CREATE_INDEX=true")
+
+REALIGNER_TARGET_CREATOR = ("-T", "RealignerTargetCreator",
+                            "-R", "{reference}",
+                            "-I", "{input_bam}",
+                            "-o", "{targets}",
+                            "-known", "{indel1}",
+                            "-known", "{indel2}",
+                            "-nt", "{num_cores}")
+
+INDEL_REALIGNER = ("-T", "IndelRealigner",
+                   "-R", "{reference}",
+                   "-I", "{input_bam}",
+                   "-known", "{indel1}",
+                   "-known", "{indel2}",
+                   "-targetIntervals", "{targets}",
+                   "--read_filter", "NotPrimaryAlignment",
+                   "-o", "{output_bam}")
+
+BASE_RECALIBRATOR = ("-T", "BaseRecalibrator",
+                     "-R", "{reference}",
+                     "-I", "{input_bam}",
+                     "-o", "{recal_config}",
+                     "--knownSites", "{dbsnp}",
+                     "-nct", "{num_cores}")
+
+PRINT_READS = ("-T", "PrintReads",
+               "-R", "{reference}",
+               "-I", "{input_bam}",
+               "-o", "{output_bam}",
+               "-BQSR", "{recal_config}",
+               "-nct", "{num_cores}")
+
+MERGE_SAM_FILES = ("MergeSamFiles",
+                   "O={output_bam}",
+                   "USE_THREADING=True")
+
+
+class GATKContext(namedtuple('GATKContext', ['reference', 'dbsnp', 'indel1', 'indel2',
+                                             'coverage_threshold', 'coverage_loci_threshold',
+                                             'bad_mate_threshold', 'quality_loci_threshold',
+                                             'mq0_threshold', 'var_qual_threshold', 'map_qual_threshold'])):
+    """The configuration values shared by GATK and Picard commands, read once per job. Values missing from the
+    configuration are None and raise a KeyError if a command template requires them.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config):
+        """Flatten the shared values of the configuration dictionary
+        :param config: The configuration dictionary.
+        :type config: dict.
+        :returns:  GATKContext -- The job context.
+        """
+
+        return cls(*[config.get(field) for field in cls._fields])
+
+    def command(self, tool_config, template, parallel_gc=False, **fields):
+        """Build the command line for a Java tool from its configuration and argument template
+        :param tool_config: The configuration dictionary of the tool.
+        :type tool_config: dict.
+        :param template: The tool arguments, with fields to substitute in addition to the shared values.
+        :type template: tuple.
+        :param parallel_gc: The tool is multithreaded and should use the parallel garbage collector.
+        :type parallel_gc: bool.
+        :returns:  list -- The command line arguments.
+        """
+
+        # GATK walkers are selected with -T, Picard tools are the first argument
+        tool = template[1] if template[0] == "-T" else template[0]
+
+        xmx = pipeline.java_xmx(tool_config.get('max_mem'))
+        if tool in TOOL_MAX_MEM:
+            xmx = min(xmx, TOOL_MAX_MEM[tool])
+
+        values = dict((field, value) for field, value in zip(self._fields, self) if value is not None)
+        values.update(fields)
+
+        command = pipeline.java_command(tool_config['bin'], pipeline.java_opts(xmx, parallel_gc=parallel_gc))
+        command.extend(arg.format(**values) if "{" in arg else arg for arg in template)
+
+        return command
+
+
+def _link(source, link_name):
+    """Hardlink a file to an alternative name, falling back to a symlink where a hardlink is not possible
+    :param source: The existing file name.
+    :type source: str.
+    :param link_name: The alternative file name.
+    :type link_name: str.
+    """
+
+    # Replace a link left behind by a previous attempt of the job
+    if os.path.lexists(link_name):
+        os.remove(link_name)
+
+    # Hardlinks fail across filesystems, on filesystems without support, or under fs.protected_hardlinks
+    try:
+        os.link(source, link_name)
+    except OSError as e:
+        if e.errno not in HARDLINK_UNSUPPORTED or not os.path.exists(source):
+            raise
+        # Both names are in the same directory, so a relative target survives moving the directory
+        os.symlink(os.path.basename(source), link_name)
+
 
 def diagnosetargets(job, config, name, samples, input_bam):
     """Run GATK's DiagnoseTargets against the supplied region
@@ -23,34 +210,20 @@ def diagnosetargets(job, config, name, samples, input_bam):
     :returns:  str -- The DiagnoseTargets output vcf file name.
     """
 
+    ctx = GATKContext.from_config(config)
+
     diagnose_targets_vcf = "{}.diagnosetargets.vcf".format(name)
     missing_intervals = "{}.missing.intervals".format(name)
     logfile = "{}.diagnose_targets.log".format(name)
 
-    command = ["{}".format(config['gatk']['bin']),
-               "-T",
-               "DiagnoseTargets",
-               "-R",
-               "{}".format(config['reference']),
-               "-L",
-               "{}".format(samples[name]['regions']),
-               "--coverage_status_threshold",
-               "{}".format(config['coverage_loci_threshold']),
-               "--bad_mate_status_threshold",
-               "{}".format(config['bad_mate_threshold']),
-               "--minimum_coverage",
-               "{}".format(config['coverage_threshold']),
-               "--quality_status_threshold",
-               "{}".format(config['quality_loci_threshold']),
-               "-I",
-               "{}".format(input_bam),
-               "-o",
-               "{}".format(diagnose_targets_vcf),
-               "--missing_intervals",
-               "{}".format(missing_intervals)]
+    command = ctx.command(config['gatk'], DIAGNOSE_TARGETS,
+                          regions=samples[name]['regions'],
+                          input_bam=input_bam,
+                          output_vcf=diagnose_targets_vcf,
+                          missing_intervals=missing_intervals)
 
     job.fileStore.logToMaster("GATK DiagnoseTargets Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_and_log_command(command, logfile, env=pipeline.java_env())
 
     return diagnose_targets_vcf
 
@@ -70,36 +243,21 @@ def diagnose_pooled_targets(job, config, name, regions, samples, input_bam1, inp
     :returns:  str -- The DiagnoseTargets output vcf file name.
     """
 
+    ctx = GATKContext.from_config(config)
+
     diagnose_targets_vcf = "{}_{}.diagnosetargets.vcf".format(name, regions)
     missing_intervals = "{}_{}.missing.intervals".format(name, regions)
     logfile = "{}.{}.diagnose_targets.log".format(name, regions)
 
-    command = ["{}".format(config['gatk']['bin']),
-               "-T",
-               "DiagnoseTargets",
-               "-R",
-               "{}".format(config['reference']),
-               "-L",
-               "{}".format(samples[name][regions]),
-               "--coverage_status_threshold",
-               "{}".format(config['coverage_loci_threshold']),
-               "--bad_mate_status_threshold",
-               "{}".format(config['bad_mate_threshold']),
-               "--minimum_coverage",
-               "{}".format(config['coverage_threshold']),
-               "--quality_status_threshold",
-               "{}".format(config['quality_loci_threshold']),
-               "-I",
-               "{}".format(input_bam1),
-               "-I",
-               "{}".format(input_bam2),
-               "-o",
-               "{}".format(diagnose_targets_vcf),
-               "--missing_intervals",
-               "{}".format(missing_intervals)]
+    command = ctx.command(config['gatk'], DIAGNOSE_POOLED_TARGETS,
+                          regions=samples[name][regions],
+                          input_bam1=input_bam1,
+                          input_bam2=input_bam2,
+                          output_vcf=diagnose_targets_vcf,
+                          missing_intervals=missing_intervals)
 
     job.fileStore.logToMaster("GATK DiagnoseTargets Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_and_log_command(command, logfile, env=pipeline.java_env())
 
     return diagnose_targets_vcf
 
@@ -117,31 +275,19 @@ def annotate_vcf(job, config, name, input_vcf, input_bam):
     :returns:  str -- The output vcf file name.
     """
 
+    ctx = GATKContext.from_config(config)
+
     output_vcf = "{}.annotated.vcf".format(name)
     annotation_logfile = "{}.variantannotation.log".format(name)
 
-    annotation_command = ["{}".format(config['gatk-annotate']['bin']),
-                          "-T",
-                          "VariantAnnotator",
-                          "-R",
-                          "{}".format(config['reference']),
-                          "-nt",
-                          "{}".format(config['gatk-annotate']['num_cores']),
-                          "--group",
-                          "StandardAnnotation",
-                          "--dbsnp",
-                          "{}".format(config['dbsnp']),
-                          "-I",
-                          "{}".format(input_bam),
-                          "--variant",
-                          "{}".format(input_vcf),
-                          "-L",
-                          "{}".format(input_vcf),
-                          "-o",
-                          "{}".format(output_vcf)]
+    annotation_command = ctx.command(config['gatk-annotate'], VARIANT_ANNOTATOR, parallel_gc=True,
+                                     num_cores=pipeline.num_threads(config['gatk-annotate']['num_cores']),
+                                     input_bam=input_bam,
+                                     input_vcf=input_vcf,
+                                     output_vcf=output_vcf)
 
     job.fileStore.logToMaster("GATK VariantAnnotator Command: {}\n".format(annotation_command))
-    pipeline.run_and_log_command(" ".join(annotation_command), annotation_logfile)
+    pipeline.run_and_log_command(annotation_command, annotation_logfile, env=pipeline.java_env())
 
     return output_vcf
 
@@ -157,37 +303,17 @@ def filter_variants(job, config, name, input_vcf):
     :returns:  str -- The output vcf file name.
     """
 
+    ctx = GATKContext.from_config(config)
+
     output_vcf = "{}.filtered.vcf".format(name)
     filter_log = "{}.variantfiltration.log".format(name)
 
-    filter_command = ["{}".format(config['gatk-filter']['bin']),
-                      "-T",
-                      "VariantFiltration",
-                      "-R",
-                      "{}".format(config['reference']),
-                      "--filterExpression",
-                      "'MQ0 > {}'".format(config['mq0_threshold']),
-                      "--filterName",
-                      "'HighMQ0'",
-                      "--filterExpression",
-                      "'DP < {}'".format(config['coverage_threshold']),
-                      "--filterName",
-                      "'LowDepth'",
-                      "--filterExpression",
-                      "'QUAL < {}'".format(config['var_qual_threshold']),
-                      "--filterName",
-                      "'LowQual'",
-                      "--filterExpression",
-                      "'MQ < {}'".format(config['map_qual_threshold']),
-                      "--filterName",
-                      "'LowMappingQual'",
-                      "--variant",
-                      "{}".format(input_vcf),
-                      "-o",
-                      "{}".format(output_vcf)]
+    filter_command = ctx.command(config['gatk-filter'], VARIANT_FILTRATION,
+                                 input_vcf=input_vcf,
+                                 output_vcf=output_vcf)
 
     job.fileStore.logToMaster("GATK VariantFiltration Command: {}\n".format(filter_command))
-    pipeline.run_and_log_command(" ".join(filter_command), filter_log)
+    pipeline.run_and_log_command(filter_command, filter_log, env=pipeline.java_env())
 
     return output_vcf
 
@@ -203,21 +329,21 @@ def mark_duplicates(job, config, name, input_bam):
     :returns:  str -- The output bam file name.
     """
 
+    ctx = GATKContext.from_config(config)
+
     job.fileStore.logToMaster("Running MarkDuplicates for sample: {}".format(name))
 
     metrics_file = "{}.dedup.metrics".format(name)
     output_bam = "{}.dedup.sorted.bam".format(name)
     logfile = "{}.markduplicates.log".format(name)
 
-    command = ["{}".format(config['picard-dedup']['bin']),
-               "MarkDuplicates",
-               "CREATE_INDEX=true",
-               "METRICS_FILE={}".format(metrics_file),
-               "INPUT={}".format(input_bam),
-               "OUTPUT={}".format(output_bam)]
+    command = ctx.command(config['picard-dedup'], MARK_DUPLICATES,
+                          metrics_file=metrics_file,
+                          input_bam=input_bam,
+                          output_bam=output_bam)
 
     job.fileStore.logToMaster("Picard MarkDuplicates Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_and_log_command(command, logfile, env=pipeline.java_env())
 
     return output_bam
 
@@ -233,31 +359,20 @@ def add_or_replace_readgroups(job, config, name, input_bam):
     :returns:  str -- The output bam file name.
     """
 
+    ctx = GATKContext.from_config(config)
+
     job.fileStore.logToMaster("Running AddOrReplaceReadGroups in sample: {}".format(name))
 
     output_bam = "{}.rg.sorted.bam".format(name)
     logfile = "{}.addreadgroups.log".format(name)
-    index_log = "{}.buildindex.log".format(name)
-
-    command = ["{}".format(config['picard-add']['bin']),
-               "AddOrReplaceReadGroups",
-               "INPUT={}".format(input_bam),
-               "OUTPUT={}".format(output_bam),
-               "RGID={}".format(name),
-               "RGSM={}".format(name),
-               "RGLB={}".format(name),
-               "RGPL=illumina",
-               "RGPU=miseq"]
-
-    command2 = ["{}".format(config['picard-add']['bin']),
-                "BuildBamIndex",
-                "INPUT={}".format(output_bam)]
 
-    job.fileStore.logToMaster("GATK AddOrReplaceReadGroupsCommand Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    command = ctx.command(config['picard-add'], ADD_OR_REPLACE_READGROUPS,
+                          name=name,
+                          input_bam=input_bam,
+                          output_bam=output_bam)
 
-    job.fileStore.logToMaster("GATK BuildBamIndex Command: {}\n".format(command2))
-    pipeline.run_and_log_command(" ".join(command2), index_log)
+    job.fileStore.logToMaster("GATK AddOrReplaceReadGroupsCommand Command: {}\n".format(command))
+    pipeline.run_and_log_command(command, logfile, env=pipeline.java_env())
 
     return output_bam
 
@@ -273,28 +388,18 @@ def realign_target_creator(job, config, name, input_bam):
     :returns:  str -- The file name of the targets file.
     """
 
+    ctx = GATKContext.from_config(config)
+
     targets = "{}.targets.intervals".format(name)
     targets_log = "{}.targetcreation.log".format(name)
 
-    command = ["{}".format(config['gatk-realign']['bin']),
-               "-T",
-               "RealignerTargetCreator",
-               "-R",
-               "{}".format(config['reference']),
-               "-I",
-               "{}".format(input_bam),
-               "-o",
-               "{}".format(targets),
-               "-known",
-               "{}".format(config['indel1']),
-               "-known",
-               "{}".format(config['indel2']),
-               "-nt",
-               "{}".format(config['gatk-realign']['num_cores'])
-               ]
+    command = ctx.command(config['gatk-realign'], REALIGNER_TARGET_CREATOR, parallel_gc=True,
+                          input_bam=input_bam,
+                          targets=targets,
+                          num_cores=pipeline.num_threads(config['gatk-realign']['num_cores']))
 
     job.fileStore.logToMaster("GATK RealignerTargetCreator Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), targets_log)
+    pipeline.run_and_log_command(command, targets_log, env=pipeline.java_env())
 
     return targets
 
@@ -312,29 +417,18 @@ def realign_indels(job, config, name, input_bam, targets):
     :returns:  str -- The output bam file name.
     """
 
+    ctx = GATKContext.from_config(config)
+
     output_bam = "{}.realigned.sorted.bam".format(name)
     realign_log = "{}.realignindels.log".format(name)
 
-    command = ["{}".format(config['gatk-realign']['bin']),
-               "-T",
-               "IndelRealigner",
-               "-R",
-               "{}".format(config['reference']),
-               "-I",
-               "{}".format(input_bam),
-               "-known",
-               "{}".format(config['indel1']),
-               "-known",
-               "{}".format(config['indel2']),
-               "-targetIntervals",
-               "{}".format(targets),
-               "--read_filter",
-               "NotPrimaryAlignment",
-               "-o",
-               "{}".format(output_bam)]
+    command = ctx.command(config['gatk-realign'], INDEL_REALIGNER,
+                          input_bam=input_bam,
+                          targets=targets,
+                          output_bam=output_bam)
 
     job.fileStore.logToMaster("GATK IndelRealigner Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), realign_log)
+    pipeline.run_and_log_command(command, realign_log, env=pipeline.java_env())
 
     return output_bam
 
@@ -352,55 +446,35 @@ def recalibrator(job, config, name, input_bam):
 
     """
 
+    ctx = GATKContext.from_config(config)
+
     output_bam = "{}.recalibrated.sorted.bam".format(name)
     recal_config = "{}.recal".format(name)
     recal_log = "{}.recalibrate.log".format(name)
     print_log = "{}.printrecalibrated.log".format(name)
-    cp_log = "{}.copy.log".format(name)
 
     # Calculate covariates
-    recal_commands = ["{}".format(config['gatk-recal']['bin']),
-                      "-T",
-                      "BaseRecalibrator",
-                      "-R",
-                      "{}".format(config['reference']),
-                      "-I",
-                      "{}".format(input_bam),
-                      "-o",
-                      "{}".format(recal_config),
-                      "--knownSites",
-                      "{}".format(config['dbsnp']),
-                      "-nct",
-                      "{}".format(config['gatk-recal']['num_cores'])]
+    recal_commands = ctx.command(config['gatk-recal'], BASE_RECALIBRATOR, parallel_gc=True,
+                                 input_bam=input_bam,
+                                 recal_config=recal_config,
+                                 num_cores=pipeline.num_threads(config['gatk-recal']['num_cores']))
 
     # Print recalibrated BAM
-    print_reads_command = ["{}".format(config['gatk-recal']['bin']),
-                           "-T",
-                           "PrintReads",
-                           "-R",
-                           "{}".format(config['reference']),
-                           "-I",
-                           "{}".format(input_bam),
-                           "-o",
-                           "{}".format(output_bam),
-                           "-BQSR",
-                           "{}".format(recal_config),
-                           "-nct",
-                           "{}".format(config['gatk-recal']['num_cores'])]
-
-    # Copy index to alternative name
-    cp_command = ["cp",
-                  "{}.recalibrated.sorted.bai".format(name),
-                  "{}.recalibrated.sorted.bam.bai".format(name)]
+    print_reads_command = ctx.command(config['gatk-recal'], PRINT_READS, parallel_gc=True,
+                                      input_bam=input_bam,
+                                      output_bam=output_bam,
+                                      recal_config=recal_config,
+                                      num_cores=pipeline.num_threads(config['gatk-recal']['num_cores']))
 
     job.fileStore.logToMaster("GATK BaseRecalibrator Command: {}\n".format(recal_commands))
-    pipeline.run_and_log_command(" ".join(recal_commands), recal_log)
+    pipeline.run_and_log_command(recal_commands, recal_log, env=pipeline.java_env())
 
     job.fileStore.logToMaster("GATK PrintReads Command: {}\n".format(print_reads_command))
-    pipeline.run_and_log_command(" ".join(print_reads_command), print_log)
+    pipeline.run_and_log_command(print_reads_command, print_log, env=pipeline.java_env())
 
-    job.fileStore.logToMaster("GATK Copy Command: {}\n".format(cp_command))
-    pipeline.run_and_log_command(" ".join(cp_command), cp_log)
+    # Hardlink index to alternative name
+    job.fileStore.logToMaster("Linking index {}.recalibrated.sorted.bai\n".format(name))
+    _link("{}.recalibrated.sorted.bai".format(name), "{}.recalibrated.sorted.bam.bai".format(name))
 
     return output_bam
 
@@ -416,18 +490,16 @@ def merge_sam(job, config, name, input_bams):
     :returns:  str -- The output bam file name.
     """
 
+    ctx = GATKContext.from_config(config)
+
     output_sam = "{}.merged.sorted.bam".format(name)
     logfile = "{}.mergesam.log".format(name)
 
-    bam_string = " I=".join(input_bams)
-
-    command = ["{}".format(config['picard-merge']['bin']),
-               "MergeSamFiles",
-               "I={}".format(bam_string),
-               "O={}".format(output_sam),
-               "USE_THREADING=True"]
+    command = ctx.command(config['picard-merge'], MERGE_SAM_FILES, parallel_gc=True,
+                          output_bam=output_sam)
+    command.extend("I={}".format(input_bam) for input_bam in input_bams)
 
     job.fileStore.logToMaster("Picard MergeSam Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_and_log_command(command, logfile, env=pipeline.java_env())
 
     return output_sam
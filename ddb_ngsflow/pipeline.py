@@ -8,32 +8,273 @@
 
 """
 
+import os
 import sys
+import shlex
+import psutil
+import multiprocessing
 import subprocess as sub
 
+# Mount points and memory limit files of the cgroup v2 and v1 hierarchies, used for limits imposed by Docker or
+# the scheduler
+CGROUP_V2_MEMORY = ("/sys/fs/cgroup", "memory.max")
+CGROUP_V1_MEMORY = ("/sys/fs/cgroup/memory", "memory.limit_in_bytes")
 
-def run_and_log_command(command, logfile):
+# Fraction of available memory given to the JVM heap, leaving headroom for native libraries and GC metadata
+JAVA_HEAP_FRACTION = 0.8
+
+# glibc otherwise creates a malloc arena per core, inflating JVM virtual memory far beyond -Xmx
+JAVA_ENV = {'MALLOC_ARENA_MAX': '2'}
+
+
+def java_env():
+    """Return a copy of the current environment suitable for launching Java tools
+
+    :returns:  dict -- The environment for the child process.
+
+    """
+
+    env = os.environ.copy()
+    env.update(JAVA_ENV)
+
+    return env
+
+
+def _cgroup_memory_limit_files():
+    """Return the memory limit files of the cgroup this process belongs to and of all its ancestors. A scheduler
+    such as Slurm sets the job's limit on the job's own cgroup rather than on the root of the hierarchy.
+
+    :returns:  list -- The memory limit file names, which may not exist.
+
+    """
+
+    cgroups = list()
+    try:
+        with open("/proc/self/cgroup", "r") as cgroup_file:
+            for line in cgroup_file:
+                hierarchy, controllers, path = line.strip().split(":", 2)
+                if hierarchy == "0" and not controllers:
+                    cgroups.append(CGROUP_V2_MEMORY + (path,))
+                elif "memory" in controllers.split(","):
+                    cgroups.append(CGROUP_V1_MEMORY + (path,))
+    except (IOError, ValueError):
+        pass
+
+    # The root limits apply inside a cgroup namespace, such as a Docker container
+    cgroups.extend([CGROUP_V2_MEMORY + ("/",), CGROUP_V1_MEMORY + ("/",)])
+
+    limit_files = list()
+    for mount, limit_name, path in cgroups:
+        while True:
+            limit_file = os.path.join(mount + path.rstrip("/"), limit_name)
+            if limit_file not in limit_files:
+                limit_files.append(limit_file)
+            if path in ("/", ""):
+                break
+            path = os.path.dirname(path)
+
+    return limit_files
+
+
+def available_memory():
+    """Return the memory available to this process, honouring any cgroup limit
+
+    :returns:  int -- The available memory in bytes.
+
+    """
+
+    available = psutil.virtual_memory().available
+    for path in _cgroup_memory_limit_files():
+        try:
+            with open(path, "r") as limit_file:
+                limit = limit_file.read().strip()
+        except IOError:
+            continue
+        if limit.isdigit():
+            available = min(available, int(limit))
+
+    return available
+
+
+def java_xmx(max_mem=None):
+    """Return the JVM maximum heap size as a fraction of the memory available to this process
+
+    :param max_mem: The configured maximum memory in GB, used as a ceiling if set.
+    :type max_mem: int.
+    :returns:  int -- The heap size in GB.
+
+    """
+
+    xmx = max(1, int(JAVA_HEAP_FRACTION * available_memory() / 1024 ** 3))
+    if max_mem:
+        xmx = min(xmx, int(max_mem))
+
+    return xmx
+
+
+def java_opts(xmx, parallel_gc=False):
+    """Return the JVM options for a tool. The heap is allocated and touched in full at startup, rather than grown
+    from a few megabytes. The JVM would otherwise start one garbage collector thread per core, so single threaded
+    tools use the serial collector and multithreaded tools a parallel collector with two threads
+
+    :param xmx: The heap size in GB.
+    :type xmx: int.
+    :param parallel_gc: Use the parallel garbage collector.
+    :type parallel_gc: bool.
+    :returns:  list -- The JVM options.
+
+    """
+
+    opts = ["-Xms{}g".format(xmx),
+            "-Xmx{}g".format(xmx),
+            "-XX:+AlwaysPreTouch"]
+    if parallel_gc:
+        opts.extend(["-XX:+UseParallelGC", "-XX:ParallelGCThreads=2"])
+    else:
+        opts.append("-XX:+UseSerialGC")
+
+    return opts
+
+
+def java_command(tool_bin, opts):
+    """Return the start of the command line for a Java tool. The configured binary is split like a shell fragment,
+    so it may be a wrapper script or a full "java -jar tool.jar" invocation. The JVM options are placed before -jar
+    when java is invoked directly, and otherwise directly after the wrapper, which must forward them to the JVM
+
+    :param tool_bin: The configured binary of the tool.
+    :type tool_bin: str.
+    :param opts: The JVM options.
+    :type opts: list.
+    :returns:  list -- The command line arguments.
+
+    """
+
+    command = shlex.split(tool_bin)
+    position = command.index("-jar") if "-jar" in command else 1
+
+    return command[:position] + list(opts) + command[position:]
+
+
+def available_cpus():
+    """Return the number of CPUs this process may run on, honouring any cgroup or scheduler affinity
+
+    :returns:  int -- The number of usable CPUs.
+
+    """
+
+    # psutil exposes the affinity mask on Python 2, sched_getaffinity only exists on Python 3
+    try:
+        return max(1, len(psutil.Process().cpu_affinity()))
+    except (AttributeError, OSError, psutil.Error):
+        pass
+
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def num_threads(num_cores=None):
+    """Return the number of threads a tool should use
+
+    :param num_cores: The configured number of cores for the job, used as a ceiling if set.
+    :type num_cores: int.
+    :returns:  int -- The number of threads.
+
+    """
+
+    threads = available_cpus()
+    if num_cores:
+        threads = min(threads, int(num_cores))
+
+    return threads
+
+
+def run_and_log_command(command, logfile, env=None, stdout_path=None):
     """This function uses the python subprocess method to run the specified command and writes all error to the
-    specified logfile
+    specified logfile. A command given as a list is executed directly without a shell, a string is passed to the
+    shell so that pipes and redirection still work.
 
     :param command: The command-line command to execute.
-    :type name: str.
+    :type name: list or str.
     :param logfile: The logfile to output error messages to.
     :type logfile: str.
+    :param env: The environment to run the command in, defaults to the current environment.
+    :type env: dict.
+    :param stdout_path: File to write the standard output of the command to.
+    :type stdout_path: str.
     :returns:  Nothing
     :raises: RuntimeError
 
     """
 
+    shell = not isinstance(command, (list, tuple))
+    command_line = command if shell else " ".join(command)
+
     with open(logfile, "wb") as err:
-        sys.stdout.write("Executing {} and writing to logfile {}\n".format(command, logfile))
-        err.write("Command: {}\n".format(command))
-        p = sub.Popen(command, stdout=sub.PIPE, stderr=err, shell=True)
-        output = p.communicate()
+        sys.stdout.write("Executing {} and writing to logfile {}\n".format(command_line, logfile))
+        err.write("Command: {}\n".format(command_line))
+        err.flush()
+        out = open(stdout_path, "wb") if stdout_path else sub.PIPE
+        try:
+            p = sub.Popen(command, stdout=out, stderr=err, shell=shell, env=env)
+            output = p.communicate()
+        finally:
+            if stdout_path:
+                out.close()
         code = p.returncode
         if code:
             raise RuntimeError("An error occurred when executing the commandline: {}. "
-                               "Please check the logfile {} for details\n".format(command, logfile))
+                               "Please check the logfile {} for details\n".format(command_line, logfile))
+
+
+def run_and_log_pipeline(commands, logfile, env=None, stdout_path=None):
+    """Run the specified commands connected by pipes, without a shell, and write all errors to the specified logfile
+
+    :param commands: The command-line commands to execute, each as a list of arguments.
+    :type commands: list.
+    :param logfile: The logfile to output error messages to.
+    :type logfile: str.
+    :param env: The environment to run the commands in, defaults to the current environment.
+    :type env: dict.
+    :param stdout_path: File to write the standard output of the last command to.
+    :type stdout_path: str.
+    :returns:  Nothing
+    :raises: RuntimeError
+
+    """
+
+    command_line = " | ".join(" ".join(command) for command in commands)
+
+    with open(logfile, "wb") as err:
+        sys.stdout.write("Executing {} and writing to logfile {}\n".format(command_line, logfile))
+        err.write("Command: {}\n".format(command_line))
+        err.flush()
+        out = open(stdout_path, "wb") if stdout_path else sub.PIPE
+        processes = list()
+        try:
+            for i, command in enumerate(commands):
+                stdin = processes[-1].stdout if processes else None
+                stdout = out if i == len(commands) - 1 else sub.PIPE
+                processes.append(sub.Popen(command, stdin=stdin, stdout=stdout, stderr=err, env=env))
+                if stdin:
+                    # Let the upstream process receive SIGPIPE if a downstream process exits
+                    stdin.close()
+            processes[-1].communicate()
+            codes = [p.wait() for p in processes]
+        except BaseException:
+            # Do not leave earlier commands of the pipeline running if a later one fails to start
+            for p in processes:
+                if p.poll() is None:
+                    p.kill()
+                p.wait()
+            raise
+        finally:
+            if stdout_path:
+                out.close()
+        if any(codes):
+            raise RuntimeError("An error occurred when executing the commandline: {}. "
+                               "Please check the logfile {} for details\n".format(command_line, logfile))
 
 
 def spawn_batch_jobs(job):
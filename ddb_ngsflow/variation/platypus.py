@@ -35,7 +35,7 @@ def platypus_single(job, config, name, samples, input_bam):
                         "--assembleBrokenPairs=1",
                         "--filterDuplicates=0",
                         "--minVarFreq={}".format(config['min_alt_af']),
-                        "--nCPU={}".format(config['platypus']['num_cores']),
+                        "--nCPU={}".format(pipeline.num_threads(config['platypus']['num_cores'])),
                         "--logFileName={}".format(internal_log),
                         "--bamFiles={}".format(input_bam),
                         "--output={}".format(platypus_vcf)]